@@ -16,15 +16,30 @@ class Tangent:
         return "<value: {}> ~ <grad: {}>".format(self.value, self.grad)
 
     def __add__(self, other):
+        if not isinstance(other, Tangent):
+            other = num(other)
         v = self.value + other.value
         g = self.grad + other.grad
         return Tangent(v, g)
 
+    def __radd__(self, other):
+        return self + other
+
     def __mul__(self, other):
+        if not isinstance(other, Tangent):
+            other = num(other)
         v = self.value * other.value
         g = self.grad * other.value + self.value * other.grad
         return Tangent(v, g)
-    
+
+    def __rmul__(self, other):
+        return self * other
+
+    def __pow__(self, p):
+        v = self.value**p
+        g = p * self.value**(p-1) * self.grad
+        return Tangent(v, g)
+
 def num(x):
     # Cast number as Tangent
     return Tangent(x, 0.0)
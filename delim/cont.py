@@ -2,8 +2,14 @@
 Packing up delimited continuations into a single
 class for modularization.
 """
+import io
+import pickle
+import time
+import weakref
 
-class Done(Exception):
+# Done and _Fallback are control flow, not errors, so they derive from
+# BaseException to get past "except Exception" in user code.
+class Done(BaseException):
     def __init__(self, value):
         self.value = value
 
@@ -12,21 +18,269 @@ class Enter:
     def __init__(self):
         pass
 
+class BudgetExceeded(Exception):
+    """
+    Raised when a reset runs out of its Budget. Carries which limit was
+    hit, the results of the continuation calls that finished before it,
+    and the counters at that point.
+    """
+    def __init__(self, reason, partial, counters):
+        super().__init__("{} budget exceeded: {}".format(reason, counters))
+        self.reason   = reason
+        self.partial  = partial
+        self.counters = counters
+
+class Budget:
+    """
+    Limits on the work done by a single reset: how many times its
+    continuations may be replayed, how long a tape may grow, how deep
+    resets may nest inside it, and how many seconds it may run. Limits
+    left as None are not enforced. A budget passed to a reset nested in
+    one it already bounds keeps counting from where it was.
+    """
+    def __init__(self, max_replays=None, max_tape=None, max_depth=None,
+                 timeout=None):
+        self.max_replays = max_replays
+        self.max_tape    = max_tape
+        self.max_depth   = max_depth
+        self.timeout     = timeout
+        self.start()
+
+    def start(self):
+        # Zero the counters and the clock
+        self.replays = 0
+        self.tape    = 0
+        self.depth   = 0
+        self.started = time.monotonic()
+        self.partial = []
+
+    def counters(self):
+        return {"replays": self.replays, "tape": self.tape,
+                "depth": self.depth,
+                "elapsed": time.monotonic() - self.started}
+
+    def exceeded(self, reason):
+        raise BudgetExceeded(reason, list(self.partial), self.counters())
+
+    def check_time(self):
+        if self.timeout is not None and \
+                time.monotonic() - self.started > self.timeout:
+            self.exceeded("timeout")
+
+    def count_replay(self):
+        self.replays += 1
+        if self.max_replays is not None and self.replays > self.max_replays:
+            self.exceeded("replays")
+        self.check_time()
+
+    def check_tape(self, n):
+        self.tape = max(self.tape, n)
+        if self.max_tape is not None and n > self.max_tape:
+            self.exceeded("tape")
+        self.check_time()
+
+    def check_depth(self, n):
+        self.depth = max(self.depth, n)
+        if self.max_depth is not None and n > self.max_depth:
+            self.exceeded("depth")
+        self.check_time()
+
+    def add_result(self, value):
+        self.partial.append(value)
+
+class _Fallback(BaseException):
+    # Raised when a reset on the fast path turns out to need the full
+    # engine, carrying the frame so that only its own reset handles it.
+    def __init__(self, frame):
+        self.frame = frame
+
+class _FastFrame:
+    """
+    State of a reset running on the single-shift fast path. This is
+    the baby thermometer: one state slot for the value passed into the
+    continuation, instead of a past/future tape.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.state = None
+        self.has_state = False
+        # Whether the current run has already gone through its shift
+        self.shifted = False
+
+# Header of the binary encoding of a continuation, with a format version
+_MAGIC = b"DC\x01"
+
+def _ref(fn):
+    # Name a reset body by its (module, qualified name), which only
+    # identifies it across processes when it is a module-level function
+    module = getattr(fn, "__module__", None)
+    qualname = getattr(fn, "__qualname__", None)
+    if not isinstance(module, str) or not isinstance(qualname, str) \
+            or "<" in qualname:
+        raise ValueError("{!r} is not a module-level function, so its "
+                         "continuations cannot be resumed".format(fn))
+    return (module, qualname)
+
+class _TapeUnpickler(pickle.Unpickler):
+    # Only plain values may come back from an encoded tape, so that
+    # loading a continuation cannot be made to run arbitrary code.
+    allowed = {("builtins", name) for name in
+               ["complex", "set", "frozenset", "bytearray"]}
+
+    def find_class(self, module, name):
+        if (module, name) not in self.allowed:
+            raise pickle.UnpicklingError(
+                "{}.{} is not allowed on a tape".format(module, name))
+        return super().find_class(module, name)
+
+class Continuation:
+    """
+    A continuation captured by Cont.shift. Since continuations are
+    replayed rather than stored, it is nothing more than the reset body
+    together with the tape of values to replay it with, which makes it
+    serializable whenever the body is registered with Cont.resumable.
+    """
+    def __init__(self, cont, fn, tape):
+        self.C    = cont
+        self.fn   = fn
+        self.tape = tape
+        # Source location of the shift that captured us, when tracing
+        self.loc  = None
+
+    def __call__(self, v):
+        C = self.C
+        C._count_replay()
+        try:
+            if C.tracer is None:
+                result = self._replay(v)
+            else:
+                with C.tracer.span("continuation", "continuation",
+                                   loc=self.loc):
+                    result = self._replay(v)
+        except _Stuck:
+            # This branch of a batched body needs a pending fetch. It
+            # ends here, so that its siblings can still find theirs.
+            return _PENDING
+        C._add_result(result)
+        return result
+
+    def _replay(self, v):
+        return self.C._thermometer(self.fn, self.tape + [v])
+
+    def dumps(self):
+        """
+        Encode the continuation as bytes, to be picked up again with
+        Cont.resume, possibly in another process. The values on the
+        tape have to be plain Python values: numbers, strings, bytes,
+        None, and containers of those.
+        """
+        ref = _ref(self.fn)
+        if self.C._resumable.get(ref) is not self.fn:
+            raise ValueError("{}.{} is not registered with Cont.resumable"
+                             .format(*ref))
+        return _MAGIC + pickle.dumps((ref, self.tape),
+                                     protocol=pickle.HIGHEST_PROTOCOL)
+
+class _FastContinuation(Continuation):
+    # Continuation captured on the single-shift fast path. Its tape is
+    # empty, as nothing shifted before it, so it serializes just like
+    # one from the full engine.
+    def __init__(self, cont, frame):
+        super().__init__(cont, frame.fn, [])
+        self.frame = frame
+
+    def _replay(self, v):
+        C, frame = self.C, self.frame
+        saved = (C._fast, frame.state, frame.has_state, frame.shifted)
+        C._fast = frame
+        frame.state, frame.has_state, frame.shifted = v, True, False
+        try:
+            return frame.fn()
+        except _Fallback as e:
+            if e.frame is not frame:
+                raise
+        finally:
+            C._fast, frame.state, frame.has_state, frame.shifted = saved
+        # The replay reached a second shift. Since we are the continuation
+        # of the first shift, the full engine replays us from a tape
+        # holding just v, also when we are called after the reset is over.
+        C._fell_back(frame.fn)
+        return C._thermometer(frame.fn, [v])
+
+class _Stuck(BaseException):
+    # Raised when a batched body looks at the result of a pending fetch.
+    # Like Done it is control flow, so "except Exception" lets it by.
+    pass
+
+class _Pending:
+    """
+    Stand-in for the result of a fetch that has not been performed yet,
+    so that a round of batched can go on to find later fetches that do
+    not depend on it. Arithmetic, indexing and calls on it give back the
+    stand-in. Anything that looks at its value raises _Stuck: branching,
+    comparing, hashing, formatting, attribute access, or using it as a
+    fetch key.
+    """
+    def _absorb(self, *args, **kwargs):
+        return self
+
+    def _stuck(self, *args, **kwargs):
+        raise _Stuck
+
+for _name in ["add", "sub", "mul", "matmul", "truediv", "floordiv", "mod",
+              "divmod", "pow", "and", "or", "xor", "lshift", "rshift"]:
+    setattr(_Pending, "__{}__".format(_name), _Pending._absorb)
+    setattr(_Pending, "__r{}__".format(_name), _Pending._absorb)
+for _name in ["neg", "pos", "abs", "invert", "getitem", "call"]:
+    setattr(_Pending, "__{}__".format(_name), _Pending._absorb)
+for _name in ["bool", "index", "int", "float", "complex", "round", "iter",
+              "len", "contains", "hash", "eq", "ne", "lt", "le", "gt", "ge",
+              "str", "repr", "format", "bytes", "getattr", "setattr",
+              "delattr", "setitem", "delitem", "enter", "exit"]:
+    setattr(_Pending, "__{}__".format(_name), _Pending._stuck)
+
+_PENDING = _Pending()
+
+class _Batch:
+    # Results of the fetches performed so far, and the keys found in
+    # the current round that still need to be fetched.
+    def __init__(self):
+        self.cache = {}
+        self.pending = {}
+
 class Cont:
     """
     Implementation class for delimited continuations via
     the shift/reset interface of Danvy-Filinski.
     """
-    def __init__(self):
+    def __init__(self, tracer=None):
         """
         Initialize global state necessary for delimited continuations.
         Implementation follows the functional pearl
             "Capturing the past by replaying the future."
+        Pass a delim.trace.Tracer to record resets, shifts and replays.
         """
         self.past = []
         self.future = []
         self.nest = []
         self.cur_expr = None
+        # Frame of the reset currently on the single-shift fast path
+        self._fast = None
+        # Reset bodies that were seen to shift more than once. Weak, so
+        # that bodies made afresh for each reset do not pile up in here.
+        self._multi_shift = weakref.WeakSet()
+        # Fetches of the innermost batched handler
+        self._batch = None
+        # Reset bodies whose continuations may be encoded, by name
+        self._resumable = {}
+        # Number of resets we are running inside of
+        self._depth = 0
+        # Budgets of the enclosing resets, with the reset depth at entry
+        self._budgets = []
+        self.stats = {"fast_path": 0, "fallbacks": 0, "fetch_rounds": 0}
+        self.tracer = tracer
+        if tracer is not None:
+            tracer.skip_file(__file__)
 
     @property
     def reset(self):
@@ -44,28 +298,140 @@ class Cont:
         self.past = []
         self.future = fn_future
         self.cur_expr = fn
+        # Shifts in here belong to the full engine, even when we were
+        # entered from a reset on the fast path
+        prev_fast = self._fast
+        self._fast = None
         # Run the computation
         def run():
             try:
                 return fn()
             except Done as e:
                 return e.value
-        result = run()
-        # Undo the nesting
         try:
-            # Set the thermometer state for recursive return
+            result = run()
+        finally:
+            # Undo the nesting, also when the computation raised
+            self._fast = prev_fast
             prev_expr, prev_past, prev_future = self.nest.pop()
             self.cur_expr = prev_expr
             self.past = prev_past
             self.future = prev_future
-            return result
-        except IndexError:
-            raise ValueError
+        return result
+
+    def reset(self, fn, single_shift=False, budget=None):
+        """
+        Run fn up to its shifts. single_shift hints that fn shifts exactly
+        once, so it can skip the tape. If the hint turns out wrong, the
+        reset starts over on the full engine, and whatever the shift block
+        did before its second shift is done again. Only hint bodies whose
+        shift blocks are free of side effects up to that point.
+        """
+        # A budget bounds all the work done inside this reset, including
+        # in nested resets, and ends it with BudgetExceeded when it runs out.
+        # Depth counts the resets nested inside the budgeted one, however
+        # many continuation calls lie in between.
+        self._depth += 1
+        pushed = False
+        try:
+            for active, base in self._budgets:
+                active.check_depth(self._depth - base)
+            if budget is not None and \
+                    all(active is not budget for active, _ in self._budgets):
+                budget.start()
+                self._budgets.append((budget, self._depth))
+                pushed = True
+            if self.tracer is None:
+                return self._reset(fn, single_shift)
+            with self.tracer.span("reset", "reset",
+                                  loc=self.tracer.location()):
+                return self._reset(fn, single_shift)
+        finally:
+            if pushed:
+                self._budgets.pop()
+            self._depth -= 1
 
-    def reset(self, fn):
+    def _reset(self, fn, single_shift):
+        # With single_shift, we first try the baby thermometer. The first
+        # time a second shift is seen we start over on the full engine,
+        # redoing the side effects of the run so far, and remember the body
+        # so that later resets of it skip the fast path. Other closures
+        # of the same code still get to try it.
+        if single_shift and not self._known_multi_shift(fn):
+            frame = _FastFrame(fn)
+            try:
+                result = self._fast_reset(frame)
+                self.stats["fast_path"] += 1
+                return result
+            except _Fallback as e:
+                if e.frame is not frame:
+                    raise
+                self._fell_back(fn)
         return self._thermometer(fn, [])
 
+    def _fell_back(self, fn):
+        try:
+            self._multi_shift.add(fn)
+        except TypeError:
+            # Not weakly referenceable, so it cannot be remembered
+            pass
+        self.stats["fallbacks"] += 1
+
+    def _known_multi_shift(self, fn):
+        try:
+            return fn in self._multi_shift
+        except TypeError:
+            return False
+
+    def forget_fallbacks(self):
+        """
+        Let every reset body try the single-shift fast path again.
+        """
+        self._multi_shift.clear()
+
+    def _fast_reset(self, frame):
+        prev_fast = self._fast
+        self._fast = frame
+        try:
+            return frame.fn()
+        except Done as e:
+            return e.value
+        finally:
+            self._fast = prev_fast
+
+    def _fast_shift(self, frame, fn):
+        if self.tracer is not None:
+            start = self.tracer.now()
+        # A second shift in the same run means the hint was wrong.
+        if frame.shifted:
+            raise _Fallback(frame)
+        frame.shifted = True
+        # On a replay the shift block is just the value passed to k.
+        if frame.has_state:
+            if self.tracer is not None:
+                self._replayed(start)
+            return frame.state
+        raise Done(self._handle(fn, _FastContinuation(self, frame)))
+
+    def _handle(self, fn, k):
+        # Run the body of a shift block on its continuation
+        if self.tracer is None:
+            return fn(k)
+        k.loc = self.tracer.location()
+        with self.tracer.span("shift", "shift", loc=k.loc):
+            return fn(k)
+
+    def _replayed(self, start):
+        # Time a shift that was answered from the tape
+        end = self.tracer.now()
+        self.tracer.complete("replayed shift", "replay", start, end,
+                             loc=self.tracer.location())
+
     def shift(self, fn):
+        if self._fast is not None:
+            return self._fast_shift(self._fast, fn)
+        if self.tracer is not None:
+            start = self.tracer.now()
         # The thermometer (which is the future) contains the values of all
         # effectful computations that have perspired until this shift block.
         # If the next value in the future stack is a value, that means
@@ -85,13 +451,12 @@ class Cont:
             # During the replay, we'll replay the entire computation with the
             # state set to the value called in shift, so that on the next-pass
             # the other if condition will ignore this shift block.
-            new_future = list(reversed(self.past))
-            our_expr = self.cur_expr
-            def k(v):
-                return self._thermometer(our_expr, new_future + [v])
+            k = Continuation(self, self.cur_expr, self.past.copy())
             self.past.append(None)
+            for budget, _ in self._budgets:
+                budget.check_tape(len(self.past))
             # Recursively call the replay
-            result = fn(k)
+            result = self._handle(fn, k)
             # When we hit a result, create an exception to abort the computation in
             # the reset block so that we don't perform the further computation outside
             # of the shift blocks.
@@ -99,8 +464,114 @@ class Cont:
         # Case 2
         elif case == 2:
             self.past.append(val)
+            for budget, _ in self._budgets:
+                budget.check_tape(len(self.past))
+            if self.tracer is not None:
+                self._replayed(start)
             return val
 
+    def _count_replay(self):
+        for budget, _ in self._budgets:
+            budget.count_replay()
+
+    def _add_result(self, value):
+        for budget, _ in self._budgets:
+            budget.add_result(value)
+
+    def fetch(self, key):
+        """
+        Look up key through the enclosing batched handler.
+        """
+        batch = self._batch
+        if batch is None:
+            raise RuntimeError("fetch called outside of batched")
+        # A key computed from a pending fetch depends on it, so it has
+        # to wait for the next round.
+        if type(key) is _Pending:
+            return _PENDING
+        if key in batch.cache:
+            return batch.cache[key]
+        batch.pending[key] = None
+        return _PENDING
+
+    def batched(self, fn, bulk):
+        """
+        Run fn as a reset in which fetch is handled in bulk. Each round
+        replays fn, answering fetches from the results of earlier rounds.
+        A fetch that misses records its key and hands back a stand-in, so
+        the round goes on to find every fetch that does not depend on
+        it; bulk is then called once with the list of all of their keys,
+        and returns the values in the same order. Code that looks at a
+        stand-in ends its branch, and the result of a round with pending
+        fetches is thrown away. Rounds go on until fn runs through with
+        every fetch answered.
+
+        As in any reset, code outside of the fetches runs again on each
+        round; side effects that store a result without looking at it
+        may store a stand-in.
+        """
+        batch = _Batch()
+        prev_batch = self._batch
+        self._batch = batch
+        try:
+            while True:
+                batch.pending = {}
+                try:
+                    result = self.reset(fn)
+                except _Stuck:
+                    if not batch.pending:
+                        raise RuntimeError("the result of a fetch was used "
+                                           "outside of its batched round")
+                if not batch.pending:
+                    return result
+                keys = list(batch.pending)
+                values = list(bulk(keys))
+                if len(values) != len(keys):
+                    raise ValueError("bulk returned {} values for {} keys"
+                                     .format(len(values), len(keys)))
+                batch.cache.update(zip(keys, values))
+                self.stats["fetch_rounds"] += 1
+        finally:
+            self._batch = prev_batch
+
+    def resumable(self, fn):
+        """
+        Register fn, a module-level reset body whose shifts go through
+        this instance, as one whose continuations may be encoded and
+        resumed. Use it as a decorator; a process resuming a
+        continuation has to register the body too, typically by
+        importing its module.
+        """
+        self._resumable[_ref(fn)] = fn
+        return fn
+
+    def load(self, blob):
+        """
+        Decode a continuation encoded with Continuation.dumps, attached
+        to this instance. Blobs may come from untrusted places: only
+        plain values are decoded, and only bodies registered with
+        resumable on this instance are ever run.
+        """
+        if not isinstance(blob, bytes) or not blob.startswith(_MAGIC):
+            raise ValueError("not an encoded continuation")
+        try:
+            ref, tape = _TapeUnpickler(io.BytesIO(blob[len(_MAGIC):])).load()
+            ref = tuple(ref)
+            fn = self._resumable.get(ref)
+        except Exception as e:
+            raise ValueError("malformed continuation: {}".format(e))
+        if fn is None or not isinstance(tape, list):
+            raise ValueError("{} is not a resumable body of this Cont"
+                             .format(".".join(map(str, ref))))
+        return Continuation(self, fn, tape)
+
+    def resume(self, blob, value):
+        """
+        Resume a suspended computation by passing value into an
+        encoded continuation.
+        """
+        return self.load(blob)(value)
+
 if __name__ == "__main__":
     C = Cont()
 
@@ -112,4 +583,29 @@ if __name__ == "__main__":
 
     ex3 = 1 + C.reset(lambda: 2 + C.shift(lambda k:
         3 * C.shift(lambda l: l(k(10)))))
-    print(ex3) # => 37
\ No newline at end of file
+    print(ex3) # => 37
+
+    # Single-shift bodies can skip the tape entirely
+    ex4 = C.reset(lambda: 1 + C.shift(lambda k: k(1) * k(2) * k(3)),
+        single_shift=True)
+    print(ex4) # => 24
+
+    # A wrong hint falls back to the full engine
+    ex5 = 1 + C.reset(lambda: 2 + C.shift(lambda k:
+        3 * C.shift(lambda l: l(k(10)))), single_shift=True)
+    print(ex5) # => 37
+    print(C.stats) # => {'fast_path': 1, 'fallbacks': 1, 'fetch_rounds': 0}
+
+    # Continuations of registered bodies can be saved and resumed later
+    @C.resumable
+    def suspended():
+        return 2 * C.shift(lambda k: k.dumps())
+    blob = C.reset(suspended)
+    print(C.resume(blob, 5)) # => 10
+
+    # A budget stops a reset that would replay too often
+    try:
+        C.reset(lambda: C.shift(lambda k: [k(x) for x in range(10)]),
+            budget=Budget(max_replays=3))
+    except BudgetExceeded as e:
+        print(e.reason, e.partial) # => replays [0, 1, 2]
\ No newline at end of file
@@ -65,7 +65,7 @@ def shift(fn):
         # During the replay, we'll replay the entire computation with the
         # state set to the value called in shift, so that on the next-pass
         # the other if condition will ignore this shift block.
-        new_future = list(reversed(past))
+        new_future = past.copy()
         our_expr = cur_expr
         def k(v):
             return thermometer(our_expr, new_future + [v])
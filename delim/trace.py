@@ -0,0 +1,86 @@
+"""
+Tracing of resets, shifts and replays, exported in the Chrome
+trace-event format so that a run can be opened in Perfetto or
+chrome://tracing.
+"""
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+class Tracer:
+    """
+    Collects timed spans from a Cont (and anything built on top of it).
+    Spans of shifts and continuations are named after the source line of
+    the shift call, so time spent replaying adds up per shift site.
+    """
+    def __init__(self):
+        self.events = []
+        # Files whose frames are skipped when looking for the shift call,
+        # under every name co_filename may give them, so that looking a
+        # frame up costs a set lookup and no path handling.
+        self.internal = set()
+        self._origin = time.perf_counter()
+
+    def skip_file(self, path):
+        self.internal.add(path)
+        self.internal.add(os.path.abspath(path))
+        self.internal.add(os.path.realpath(path))
+
+    def location(self):
+        """
+        Source location of the innermost frame outside of the internal
+        files, i.e. the line in user code that called into them.
+        """
+        internal = self.internal
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_filename in internal:
+            frame = frame.f_back
+        if frame is None:
+            return None
+        return "{}:{}".format(frame.f_code.co_filename, frame.f_lineno)
+
+    def now(self):
+        # Trace-event timestamps are in microseconds
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def _event(self, name, cat, ph, ts, loc, args):
+        if loc is not None:
+            name = "{} {}".format(name, os.path.basename(loc))
+            args = dict(args, loc=loc)
+        event = {"name": name, "cat": cat, "ph": ph, "ts": ts,
+                 "pid": os.getpid(), "tid": threading.get_ident(),
+                 "args": args}
+        self.events.append(event)
+        return event
+
+    @contextlib.contextmanager
+    def span(self, name, cat, loc=None, **args):
+        """
+        Record the time spent in the with-block as a complete event.
+        The block gets the args of the event, to add what it finds out.
+        """
+        start = self.now()
+        try:
+            yield args
+        finally:
+            event = self._event(name, cat, "X", start, loc, args)
+            event["dur"] = self.now() - start
+
+    def complete(self, name, cat, start, end, loc=None, **args):
+        """
+        Record a span timed by the caller, for steps where a with-block
+        would not fit.
+        """
+        event = self._event(name, cat, "X", start, loc, args)
+        event["dur"] = end - start
+
+    def to_json(self):
+        return json.dumps({"traceEvents": self.events,
+                           "displayTimeUnit": "ms"})
+
+    def export(self, path):
+        with open(path, "w") as f:
+            f.write(self.to_json())
\ No newline at end of file
@@ -1,5 +1,6 @@
 import numpy as np
 from delim.cont import Cont
+from autodiff.forward import Tangent
 
 class Dual:
     """
@@ -110,8 +111,13 @@ class Autodifferentiator:
     of a Zariski tangent space for purposes of reverse-mode
     automatic differentiation.
     """
-    def __init__(self):
-        self.C = Cont()
+    def __init__(self, tracer=None):
+        self.C = Cont(tracer)
+        self.stats = {}
+        self.tracer = tracer
+        # Attribute shifts to the user's arithmetic rather than to Dual
+        if tracer is not None:
+            tracer.skip_file(__file__)
 
     def grad(self, fn):
         def grad_fn(x):
@@ -119,14 +125,107 @@ class Autodifferentiator:
             def g():
                 res = fn(z)
                 res.set_grad(1.0)
-            self.C.reset(g)
+            if self.tracer is None:
+                self.C.reset(g)
+            else:
+                with self.tracer.span("grad", "autodiff",
+                                      loc=self.tracer.location()):
+                    self.C.reset(g)
             return z.grad
         return grad_fn
 
+    def derivative(self, fn, mode=None):
+        """
+        Differentiate fn with whichever engine is cheaper. Forward mode
+        costs one pass per input and reverse mode one replayed pass per
+        output; the first forward pass counts the outputs before
+        dispatching. Pass mode="forward" or mode="reverse" to
+        override the choice; the chosen mode is recorded in self.stats.
+        """
+        if mode not in (None, "forward", "reverse"):
+            raise ValueError("unknown mode: {}".format(mode))
+        def derivative_fn(*xs):
+            if self.tracer is None:
+                return self._derivative(fn, mode, xs)
+            with self.tracer.span("derivative", "autodiff",
+                                  loc=self.tracer.location()) as args:
+                result = self._derivative(fn, mode, xs)
+                args["mode"] = self.stats["mode"]
+                return result
+        return derivative_fn
+
+    def _derivative(self, fn, mode, xs):
+        n_in = len(xs)
+        chosen = mode
+        if chosen == "reverse":
+            jac = self._reverse_jacobian(fn, xs)
+        else:
+            # The first forward pass doubles as the trace that counts the
+            # outputs, and its column is kept if forward mode wins.
+            first = self._forward_column(fn, xs, 0)
+            n_out = len(first)
+            if chosen is None:
+                # Ties go to forward mode, which does not pay for replay.
+                chosen = "forward" if n_in <= n_out else "reverse"
+            if chosen == "forward":
+                columns = [first] + [self._forward_column(fn, xs, i)
+                                     for i in range(1, n_in)]
+                jac = [list(row) for row in zip(*columns)]
+            else:
+                jac = self._reverse_jacobian(fn, xs)
+        n_out = len(jac)
+        self.stats = {"mode": chosen, "inputs": n_in, "outputs": n_out}
+        # Drop the axes of length one, so that a scalar function of
+        # one variable gives back a scalar like grad does.
+        if n_out == 1:
+            return jac[0][0] if n_in == 1 else jac[0]
+        elif n_in == 1:
+            return [row[0] for row in jac]
+        return jac
+
+    def _outputs(self, res):
+        # Outputs of a vector-valued function come back as a tuple or list.
+        if isinstance(res, (tuple, list)):
+            return list(res)
+        return [res]
+
+    def _forward_column(self, fn, xs, i):
+        # One forward pass, seeding input i's tangent with 1.
+        ts = [Tangent(x, 1.0 if j == i else 0.0) for j, x in enumerate(xs)]
+        return [y.grad if isinstance(y, Tangent) else 0.0
+                for y in self._outputs(fn(*ts))]
+
+    def _reverse_jacobian(self, fn, xs):
+        # One reverse pass per output, seeding that output's gradient with
+        # 1. The number of outputs is only known after the first pass.
+        jac = []
+        n_out = 1
+        while len(jac) < n_out:
+            r = len(jac)
+            zs = [Dual(x, self.C, 0.0) for x in xs]
+            def g():
+                nonlocal n_out
+                ys = self._outputs(fn(*zs))
+                n_out = len(ys)
+                if isinstance(ys[r], Dual):
+                    ys[r].set_grad(1.0)
+            self.C.reset(g)
+            jac.append([z.grad for z in zs])
+        return jac
 
 if __name__ == "__main__":
     auto = Autodifferentiator()
     
     fn = lambda x: x**3 + 3*x
     dfn = auto.grad(fn)
-    print(dfn(4.0))
\ No newline at end of file
+    print(dfn(4.0)) # => 51.0
+
+    dfn = auto.derivative(fn)
+    print(dfn(4.0), auto.stats["mode"]) # => 51.0 forward
+
+    fn = lambda x, y: x*y + 2*x
+    dfn = auto.derivative(fn)
+    print(dfn(3.0, 5.0), auto.stats["mode"]) # => [7.0, 3.0] reverse
+
+    dfn = auto.derivative(fn, mode="forward")
+    print(dfn(3.0, 5.0), auto.stats["mode"]) # => [7.0, 3.0] forward
\ No newline at end of file
@@ -0,0 +1,65 @@
+from delim.cont import *
+
+C = Cont()
+
+store = {"a": 1, "b": 2, "c": "a", "d": 4, 1: 10,
+         "user:1": "alice", "user:2": "bob"}
+calls = []
+
+def bulk_get(keys):
+    # One round trip to the store for the whole batch
+    calls.append(keys)
+    return [store[key] for key in keys]
+
+def get(key):
+    return C.fetch(key)
+
+def choose(x, y):
+    return C.shift(lambda k: [k(x), k(y)])
+
+def independent():
+    # Independent lookups in straight-line code go out together
+    return get("a") + get("b") + get("d")
+
+def lookups():
+    # get("a") and get("c") go out first; the lookups keyed on
+    # their values wait for the next round.
+    return get(get("a")) + get(get("c"))
+
+def profile():
+    # A key built from a fetched value is only built once it is in
+    uid = get("a")
+    return get("user:{}".format(uid))
+
+def profiles():
+    # Fetches in sibling branches go out in the same round
+    return get("user:{}".format(choose(1, 2)))
+
+def nested():
+    # A nested reset waits for its fetches like the rest of the body
+    return C.reset(lambda: get("a")) + 1
+
+if __name__ == "__main__":
+    ex1 = C.batched(independent, bulk_get)
+    print(ex1) # => 7
+    print(calls) # => [['a', 'b', 'd']]
+
+    calls.clear()
+    ex2 = C.batched(lookups, bulk_get)
+    print(ex2) # => 11
+    print(calls) # => [['a', 'c'], [1]]
+
+    calls.clear()
+    ex3 = C.batched(profile, bulk_get)
+    print(ex3) # => alice
+    print(calls) # => [['a'], ['user:1']]
+
+    calls.clear()
+    ex4 = C.batched(profiles, bulk_get)
+    print(ex4) # => ['alice', 'bob']
+    print(calls) # => [['user:1', 'user:2']]
+
+    calls.clear()
+    ex5 = C.batched(nested, bulk_get)
+    print(ex5) # => 2
+    print(calls) # => [['a']]
\ No newline at end of file
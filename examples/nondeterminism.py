@@ -1,6 +1,7 @@
 """
 Replay-based non-determinism in Python.
 """
+from delim.cont import Budget, BudgetExceeded
 
 ##################
 # 2-choice version
@@ -90,6 +91,10 @@ def with_nondeterminismM(fn):
 # The future stack contains known choices to be made.
 past   = []
 future = []
+# Number of handlers we are running inside of, and the budgets of
+# those that have one, with the handler depth at entry.
+depth   = 0
+budgets = []
 
 # The next path to choose is a modification of the current path through
 # the final leaf.
@@ -122,6 +127,8 @@ def choose(xs):
             # push it into the past.
             i = start_idx(xs)
             past.insert(0, i)
+            for budget, _ in budgets:
+                budget.check_tape(len(past))
             return get(xs, *i)
         else:
             # Otherwise, read the instruction from the future stack
@@ -130,10 +137,40 @@ def choose(xs):
             past.insert(0, i)
             return get(xs, *i)
 
-def with_nondeterminism(fn):
+def with_nondeterminism(fn, budget=None):
+    """
+    Handler for choice-- returns a reified list of
+    all choices. With a budget, raises BudgetExceeded
+    carrying the results so far once it runs out; its
+    depth counts the handlers nested inside this one.
+    """
+    global past, future, depth
+    # A nested handler replays on stacks of its own
+    saved = (past, future)
+    past, future = [], []
+    depth += 1
+    pushed = False
+    try:
+        for active, base in budgets:
+            active.check_depth(depth - base)
+        if budget is not None and \
+                all(active is not budget for active, _ in budgets):
+            budget.start()
+            budgets.append((budget, depth))
+            pushed = True
+        return replay_all(fn)
+    finally:
+        if pushed:
+            budgets.pop()
+        depth -= 1
+        past, future = saved
+
+def replay_all(fn):
     global past, future
     try:
         results = [fn()]
+        for budget, _ in budgets:
+            budget.add_result(results[0])
         next_future = list(reversed(next_path(past)))
         # Reset past/future stacks
         past   = []
@@ -141,7 +178,10 @@ def with_nondeterminism(fn):
         if len(future) == 0:
             return results
         else:
-            return results + with_nondeterminism(fn)
+            # Only runs after the first count as replays, as in Cont
+            for budget, _ in budgets:
+                budget.count_replay()
+            return results + replay_all(fn)
     except ValueError:
         return []
 
@@ -171,4 +211,9 @@ if __name__ == "__main__":
         return 2 + choose([1,2,3]) * choose([1,10,100])
 
     results = with_nondeterminism(test_fn2)
-    print(results)
\ No newline at end of file
+    print(results)
+
+    try:
+        with_nondeterminism(test_fn2, Budget(max_replays=4))
+    except BudgetExceeded as e:
+        print(e.reason, e.partial) # => replays [3, 12, 102, 4, 22]
\ No newline at end of file
@@ -0,0 +1,16 @@
+from delim.cont import *
+from delim.trace import Tracer
+
+tracer = Tracer()
+C = Cont(tracer)
+
+def choose(x, y):
+    return C.shift(lambda k: [k(x)] + [k(y)])
+
+if __name__ == "__main__":
+    ex1 = C.reset(lambda: choose(1, 2) * 10)
+    print(ex1) # => [10, 20]
+
+    # tracer.export(path) writes these out for Perfetto or chrome://tracing
+    for event in tracer.events:
+        print(event["name"])
\ No newline at end of file